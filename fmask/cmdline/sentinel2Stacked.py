@@ -25,12 +25,14 @@ import os
 import argparse
 import tempfile
 import glob
+import re
+import math
+import contextlib
+from concurrent import futures
 
 from osgeo import gdal
-from osgeo_utils import gdal_merge
 
 from rios import fileinfo
-from rios.imagewriter import DEFAULTDRIVERNAME, dfltDriverOptions
 
 from fmask import config
 from fmask import fmaskerrors
@@ -38,12 +40,36 @@ from fmask.cmdline import sentinel2makeAnglesImage
 from fmask import fmask
 from fmask import sen2meta
 
-# for GDAL.
-CMDLINECREATIONOPTIONS = []
-if DEFAULTDRIVERNAME in dfltDriverOptions:
-    for opt in dfltDriverOptions[DEFAULTDRIVERNAME]:
-        CMDLINECREATIONOPTIONS.append('-co')
-        CMDLINECREATIONOPTIONS.append(opt)
+# GDAL creation options for the intermediate stack of all bands, written as a GTiff.
+# Tiled, so fmask's block reads are efficient, and compressed (with threads) to cut
+# the bytes written and then read back several times by fmask. Band interleaved, so 
+# that reading a single band does not decompress all the others. 
+STACK_CREATIONOPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 
+    'INTERLEAVE=BAND', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'NUM_THREADS=ALL_CPUS', 
+    'BIGTIFF=IF_SAFER']
+
+# Native pixel size (metres) of each Sentinel-2 band
+S2_NATIVE_PIXSIZE = {'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 
+    'B06': 20, 'B07': 20, 'B08': 10, 'B8A': 20, 'B09': 60, 'B10': 60, 
+    'B11': 20, 'B12': 20}
+
+# Result of the sanity checks on the input options given on the command line, 
+# indexed by (safedir given << 2) | (granuledir given << 1) | (toa and anglesfile given).
+# Each entry is a tuple of (printHelp, message). If printHelp is True, the inputs are
+# invalid and the usage is printed. If message is not None, the inputs are invalid 
+# and the message is printed. Otherwise, the inputs are valid. 
+SAFE_AND_GRANULE_MSG = ("Only give one of --safedir or --granuledir. The --granuledir is only \n" +
+    "required for multi-tile zipfiles in the old ESA format")
+INPUTSTATE_CHECKS = {
+    0b000: (True, None),
+    0b001: (False, None),
+    0b010: (False, None),
+    0b011: (True, None),
+    0b100: (False, None),
+    0b101: (True, None),
+    0b110: (False, SAFE_AND_GRANULE_MSG),
+    0b111: (False, SAFE_AND_GRANULE_MSG)
+}
 
 
 def getCmdargs(argv=None):
@@ -117,65 +143,114 @@ def getCmdargs(argv=None):
     # Do some sanity checks on what was given
     safeDirGiven = (cmdargs.safedir is not None)
     granuleDirGiven = (cmdargs.granuledir is not None)
-    if granuleDirGiven and safeDirGiven:
-        print("Only give one of --safedir or --granuledir. The --granuledir is only ")
-        print("required for multi-tile zipfiles in the old ESA format")
-        sys.exit(1)
     stackAnglesGiven = (cmdargs.toa is not None and cmdargs.anglesfile is not None)
-    multipleInputGiven = (safeDirGiven or granuleDirGiven) and stackAnglesGiven
-    inputGiven = safeDirGiven or granuleDirGiven or stackAnglesGiven
-    if cmdargs.output is None or multipleInputGiven or not inputGiven:
-        parser.print_help()
+    inputState = (int(safeDirGiven) << 2) | (int(granuleDirGiven) << 1) | int(stackAnglesGiven)
+    (printHelp, message) = INPUTSTATE_CHECKS[inputState]
+    if message is None and cmdargs.output is None:
+        printHelp = True
+    if printHelp or message is not None:
+        if message is not None:
+            print(message)
+        else:
+            parser.print_help()
         sys.exit(1)
 
     return cmdargs
 
 
-def checkAnglesFile(inputAnglesFile, toafile):
+@contextlib.contextmanager
+def gdalDefaultSettings():
+    """
+    Context manager which sets some GDAL configuration defaults for reading and 
+    warping the ESA jp2 files, and puts back the previous settings on exit. 
+    Anything the user has already set, either in their environment or as a 
+    GDAL config option, is left alone. 
+    
+    """
+    # Stop GDAL listing the whole directory every time a file is opened. Sidecar 
+    # files are still found, GDAL just checks for them directly. 
+    setReaddir = (gdal.GetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN') is None)
+    if setReaddir:
+        gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE')
+
+    # Allow at least 1GB of block cache. GDAL's own default is a percentage of 
+    # the RAM, so only ever raise it, never lower it. 
+    minCacheMax = 1024 * 1024 * 1024
+    oldCacheMax = gdal.GetCacheMax()
+    setCacheMax = (gdal.GetConfigOption('GDAL_CACHEMAX') is None and oldCacheMax < minCacheMax)
+    if setCacheMax:
+        gdal.SetCacheMax(minCacheMax)
+
+    try:
+        yield
+    finally:
+        if setReaddir:
+            gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', None)
+        if setCacheMax:
+            gdal.SetCacheMax(oldCacheMax)
+
+
+def checkAnglesFile(inputAnglesFile, toafile, tempdir=None):
     """
     Check that the resolution of the input angles file matches that of the input
     TOA reflectance file. If not, make a VRT file which will resample it 
     on-the-fly. Only checks the resolution, assumes that if these match, then everything
     else will match too. 
+
+    The VRT is put on exactly the same pixel grid as the TOA file (same projection, 
+    bounds and number of rows and columns), so that fmask can read the two together 
+    without any further resampling or sub-pixel shift. It is created in tempdir, 
+    if given. 
     
-    Return the name of the angles file to use. 
+    Return a tuple of (anglesFile, toaImgInfo), where anglesFile is the name of the 
+    angles file to use, and toaImgInfo is the ImageInfo of the TOA file, so the 
+    caller need not open it again. 
     
     """
     toaImgInfo = fileinfo.ImageInfo(toafile)
     anglesImgInfo = fileinfo.ImageInfo(inputAnglesFile)
 
+    # Compare with a tolerance, as nominally equal pixel sizes read from different 
+    # formats are often not exactly equal as floating point values
+    sameRes = (math.isclose(toaImgInfo.xRes, anglesImgInfo.xRes, rel_tol=1e-6) and
+        math.isclose(toaImgInfo.yRes, anglesImgInfo.yRes, rel_tol=1e-6))
+
     outputAnglesFile = inputAnglesFile
-    if (toaImgInfo.xRes != anglesImgInfo.xRes) or (toaImgInfo.yRes != anglesImgInfo.yRes):
-        (fd, vrtName) = tempfile.mkstemp(prefix='angles', suffix='.vrt')
+    if not sameRes:
+        (fd, vrtName) = tempfile.mkstemp(dir=tempdir, prefix='angles', suffix='.vrt')
         os.close(fd)
         
-        options = gdal.WarpOptions(format='VRT', xRes=toaImgInfo.xRes, 
-            yRes=toaImgInfo.yRes, outputBounds=[toaImgInfo.xMin, toaImgInfo.yMin,
-            toaImgInfo.xMax, toaImgInfo.yMax], resampleAlg='near')
+        options = gdal.WarpOptions(format='VRT', dstSRS=toaImgInfo.projection,
+            width=toaImgInfo.ncols, height=toaImgInfo.nrows, 
+            outputBounds=[toaImgInfo.xMin, toaImgInfo.yMin,
+            toaImgInfo.xMax, toaImgInfo.yMax], resampleAlg='near',
+            multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], warpMemoryLimit=512)
         gdal.Warp(vrtName, inputAnglesFile, options=options)
 
         outputAnglesFile = vrtName
     
-    return outputAnglesFile
+    return (outputAnglesFile, toaImgInfo)
 
 
-def makeStackAndAngles(cmdargs):
+def makeStackAndAngles(cmdargs, tempdir=None):
     """
     Make an intermediate stack of all the TOA reflectance bands. Also make an image
     of the angles. Fill in the names of these in the cmdargs object. 
+
+    All intermediate files are created in tempdir, which defaults to cmdargs.tempdir.
+    The caller is responsible for removing them. 
         
     """
+    if tempdir is None:
+        tempdir = cmdargs.tempdir
     if cmdargs.granuledir is None and cmdargs.safedir is not None:
         cmdargs.granuledir = findGranuleDir(cmdargs.safedir)
 
     # Make the angles file
-    (fd, anglesfile) = tempfile.mkstemp(dir=cmdargs.tempdir, prefix="angles_tmp_", 
+    (fd, anglesfile) = tempfile.mkstemp(dir=tempdir, prefix="angles_tmp_", 
         suffix=".img")
     os.close(fd)
     xmlfile = findGranuleXml(cmdargs.granuledir)
-    if cmdargs.verbose:
-        print("Making angles image")
-    sentinel2makeAnglesImage.makeAngles(xmlfile, anglesfile)
     cmdargs.anglesfile = anglesfile
     
     # Make a stack of the reflectance bands. Not that we do an explicit resample to the
@@ -183,55 +258,95 @@ def makeStackAndAngles(cmdargs):
     # According to @vincentschut, these are shifted slightly, and should be avoided.
     bandList = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A',
         'B09', 'B10', 'B11', 'B12']
-    imgDir = "{}/IMG_DATA".format(cmdargs.granuledir)
-    resampledBands = []
-    for band in bandList:
-        (fd, tmpBand) = tempfile.mkstemp(dir=cmdargs.tempdir, prefix="tmp_{}_".format(band),
-            suffix=".vrt")
-        os.close(fd)
-        inBandImgList = glob.glob("{}/*_{}.jp2".format(imgDir, band))
-        if len(inBandImgList) != 1:
-            raise fmaskerrors.FmaskFileError("Cannot find input band {}".format(band))
-        inBandImg = inBandImgList[0]
+    inBandImgList = findBandImgList(cmdargs.granuledir, bandList)
 
-        # Now make a resampled copy to the desired pixel size, using the right resample method
-        resampleMethod = chooseResampleMethod(cmdargs.pixsize, inBandImg)
-        
-        options = gdal.WarpOptions(format='VRT', resampleAlg=resampleMethod,
-            xRes=cmdargs.pixsize, yRes=cmdargs.pixsize)
-        gdal.Warp(tmpBand, inBandImg, options=options)
-        
-        resampledBands.append(tmpBand)
+    # The angles image only depends on the XML file, so make it on a separate 
+    # thread while the bands are resampled and stacked below
+    if cmdargs.verbose:
+        print("Making angles image")
+    anglesExecutor = futures.ThreadPoolExecutor(max_workers=1)
+    anglesFuture = anglesExecutor.submit(sentinel2makeAnglesImage.makeAngles, 
+        xmlfile, anglesfile)
+    try:
+        resampledBands = makeStack(cmdargs, bandList, inBandImgList, tempdir)
+    finally:
+        # Always wait for the angles thread, even if making the stack failed, 
+        # so it is not still writing when the caller removes tempdir
+        anglesExecutor.shutdown(wait=True)
+    # Raise any exception from making the angles image
+    anglesFuture.result()
+
+    return resampledBands
+
+
+def makeStack(cmdargs, bandList, inBandImgList, tempdir):
+    """
+    Resample each of the given band files to the output pixel size, and make
+    a stack of them, all in tempdir. Sets the name of the stack as cmdargs.toa. 
+
+    Return a list of the resampled band files. 
     
-    # Now make a stack of these
+    """
+    resampledBands = []
+    for (i, band) in enumerate(bandList):
+        resampleMethod = chooseResampleMethod(cmdargs.pixsize, S2_NATIVE_PIXSIZE[band])
+        tmpBand = warpOneBand(band, inBandImgList[i], cmdargs.pixsize, 
+            resampleMethod, tempdir)
+        resampledBands.append(tmpBand)
+
+    # Now make a stack of these. The stack is put together as a VRT of the resampled 
+    # band VRTs, and then written out to a real file. Writing it out is the only 
+    # step which actually decodes and resamples the jp2 files, and it must be 
+    # done just once, because fmask reads the stack several times. 
     if cmdargs.verbose:
         print("Making stack of all bands, at {}m pixel size".format(cmdargs.pixsize))
-    (fd, tmpStack) = tempfile.mkstemp(dir=cmdargs.tempdir, prefix="tmp_allbands_",
-        suffix=".img")
+    (fd, stackVrt) = tempfile.mkstemp(dir=tempdir, prefix="tmp_allbands_",
+        suffix=".vrt")
+    os.close(fd)
+    options = gdal.BuildVRTOptions(separate=True, resolution='user',
+        xRes=cmdargs.pixsize, yRes=cmdargs.pixsize)
+    stackVrtDS = gdal.BuildVRT(stackVrt, resampledBands, options=options)
+
+    (fd, tmpStack) = tempfile.mkstemp(dir=tempdir, prefix="tmp_allbands_",
+        suffix=".tif")
     os.close(fd)
     cmdargs.toa = tmpStack
 
-    # We need to turn off exceptions while using gdal_merge, as it doesn't cope
-    usingExceptions = gdal.GetUseExceptions()
-    gdal.DontUseExceptions()
-    gdal_merge.main(['-q', '-of', DEFAULTDRIVERNAME] + CMDLINECREATIONOPTIONS + 
-        ['-separate', '-o', cmdargs.toa] + resampledBands)
-    if usingExceptions:
-        gdal.UseExceptions()
-    
-    for fn in resampledBands:
-        fmask.deleteRaster(fn)
+    options = gdal.TranslateOptions(format='GTiff', 
+        creationOptions=STACK_CREATIONOPTIONS)
+    ds = gdal.Translate(cmdargs.toa, stackVrtDS, options=options)
+    del ds
+    del stackVrtDS
 
     return resampledBands
 
 
-def chooseResampleMethod(outpixsize, inBandImg):
+def warpOneBand(band, inBandImg, pixsize, resampleMethod, tempdir):
     """
-    Choose the right resample method, given the image and the desired output pixel size
-    """
-    imginfo = fileinfo.ImageInfo(inBandImg)
-    inPixsize = imginfo.xRes
+    Make a resampled VRT of a single input band, at the given output pixel size,
+    using the given resample method. The VRT is created in tempdir. 
+
+    Return the name of the VRT file. 
     
+    """
+    (fd, tmpBand) = tempfile.mkstemp(dir=tempdir, prefix="tmp_{}_".format(band),
+        suffix=".vrt")
+    os.close(fd)
+
+    # Make a resampled copy to the desired pixel size.
+    # No pixels are warped here. The threading options are stored in the VRT, and 
+    # only take effect when pixels are read from it. 
+    options = gdal.WarpOptions(format='VRT', resampleAlg=resampleMethod,
+        xRes=pixsize, yRes=pixsize, multithread=True, 
+        warpOptions=['NUM_THREADS=ALL_CPUS'], warpMemoryLimit=512)
+    gdal.Warp(tmpBand, inBandImg, options=options)
+    return tmpBand
+
+
+def chooseResampleMethod(outpixsize, inPixsize):
+    """
+    Choose the right resample method, given the input and desired output pixel sizes
+    """
     if outpixsize == inPixsize:
         resample = "near"
     elif outpixsize > inPixsize:
@@ -242,6 +357,83 @@ def chooseResampleMethod(outpixsize, inBandImg):
     return resample
 
 
+def findBandImgList(granuleDir, bandList):
+    """
+    Find the jp2 file for each of the bands in bandList, in the IMG_DATA 
+    directory of the given granule dir. Return a list of the filenames, in 
+    the same order as bandList. 
+
+    For the new-format zipfiles, the names can be worked out directly from 
+    the name of the .SAFE directory, so we try that first. Otherwise, 
+    fall back to searching the directory. 
+    
+    """
+    imgDir = "{}/IMG_DATA".format(granuleDir)
+
+    bandFilePrefix = guessBandFilePrefix(granuleDir)
+    if bandFilePrefix is not None:
+        inBandImgList = ["{}/{}_{}.jp2".format(imgDir, bandFilePrefix, band)
+            for band in bandList]
+        if all([os.path.exists(fn) for fn in inBandImgList]):
+            return inBandImgList
+
+    # Find all the band files with a single pass over the directory
+    jp2ByBand = {}
+    for (name, path) in listDir(imgDir).items():
+        if name.endswith(".jp2") and "_" in name:
+            bandTag = name[:-4].split('_')[-1]
+            jp2ByBand.setdefault(bandTag, []).append(path)
+    inBandImgList = []
+    for band in bandList:
+        bandImgList = jp2ByBand.get(band, [])
+        if len(bandImgList) != 1:
+            raise fmaskerrors.FmaskFileError("Cannot find input band {}".format(band))
+        inBandImgList.append(bandImgList[0])
+    return inBandImgList
+
+
+def guessBandFilePrefix(granuleDir):
+    """
+    Work out the prefix of the band filenames, from the name of the .SAFE 
+    directory which contains the given granule dir. In the new-format 
+    zipfiles, a .SAFE directory such as
+        S2A_MSIL1C_20190403T101031_N0207_R022_T33UUP_20190403T122029.SAFE
+    has band files named like
+        T33UUP_20190403T101031_B01.jp2
+    i.e. the tile, and the datatake sensing time. 
+    
+    Return None if the .SAFE name does not follow this pattern (e.g. the 
+    old-format zipfiles, or a renamed directory). 
+    
+    """
+    safeDir = os.path.dirname(os.path.dirname(os.path.abspath(granuleDir)))
+    safeName = os.path.basename(safeDir)
+    match = re.match(r"S2[A-Z]_MSIL1C_(\d{8}T\d{6})_N\d{4}_R\d{3}_(T\w{5})_", safeName)
+    prefix = None
+    if match is not None:
+        (sensingTime, tile) = match.groups()
+        prefix = "{}_{}".format(tile, sensingTime)
+    return prefix
+
+
+def listDir(dirname):
+    """
+    Return a dictionary of the entries in the given directory, keyed by 
+    name, with the full path as the value. This is a single pass over the 
+    directory, which can then be searched any number of times. As with glob, 
+    hidden files (starting with '.') are skipped. If the directory does not 
+    exist, returns an empty dictionary. 
+    
+    """
+    entries = {}
+    if os.path.isdir(dirname):
+        with os.scandir(dirname) as dirIter:
+            for entry in dirIter:
+                if not entry.name.startswith('.'):
+                    entries[entry.name] = "{}/{}".format(dirname, entry.name)
+    return entries
+
+
 def findGranuleDir(safedir):
     """
     Search the given .SAFE directory, and find the main XML file at the GRANULE level.
@@ -252,7 +444,8 @@ def findGranuleDir(safedir):
     
     """
     granuleDirPattern = "{}/GRANULE/L1C_*".format(safedir)
-    granuleDirList = glob.glob(granuleDirPattern)
+    granuleDirList = [path for (name, path) in listDir("{}/GRANULE".format(safedir)).items()
+        if name.startswith("L1C_")]
     if len(granuleDirList) == 0:
         raise fmaskerrors.FmaskFileError("Unable to find GRANULE sub-directory {}".format(granuleDirPattern))
     elif len(granuleDirList) > 1:
@@ -271,8 +464,8 @@ def findGranuleXml(granuleDir):
     xmlfile = "{}/MTD_TL.xml".format(granuleDir)
     if not os.path.exists(xmlfile):
         # Might be old-format zipfile, so search for *.xml
-        xmlfilePattern = "{}/*.xml".format(granuleDir)
-        xmlfileList = glob.glob(xmlfilePattern)
+        xmlfileList = [path for (name, path) in listDir(granuleDir).items()
+            if name.endswith(".xml")]
         if len(xmlfileList) == 1:
             xmlfile = xmlfileList[0]
         else:
@@ -351,46 +544,52 @@ def mainRoutine(argv=None):
     If argv is None or not given, command line sys.args are used, see argparse.parse_args.
     """
     cmdargs = getCmdargs(argv)
-    tempStack = False
-    if cmdargs.safedir is not None or cmdargs.granuledir is not None:
-        tempStack = True
-        makeStackAndAngles(cmdargs)
-    topMeta = readTopLevelMeta(cmdargs)
-    
-    anglesfile = checkAnglesFile(cmdargs.anglesfile, cmdargs.toa)
-    anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
-    
-    fmaskFilenames = config.FmaskFilenames()
-    fmaskFilenames.setTOAReflectanceFile(cmdargs.toa)
-    fmaskFilenames.setOutputCloudMaskFile(cmdargs.output)
-    
-    fmaskConfig = config.FmaskConfig(config.FMASK_SENTINEL2)
-    fmaskConfig.setAnglesInfo(anglesInfo)
-    fmaskConfig.setKeepIntermediates(cmdargs.keepintermediates)
-    fmaskConfig.setVerbose(cmdargs.verbose)
-    fmaskConfig.setTempDir(cmdargs.tempdir)
-    fmaskConfig.setTOARefScaling(topMeta.scaleVal)
-    offsetDict = makeRefOffsetDict(topMeta)
-    fmaskConfig.setTOARefOffsetDict(offsetDict)
-    fmaskConfig.setMinCloudSize(cmdargs.mincloudsize)
-    fmaskConfig.setEqn17CloudProbThresh(cmdargs.cloudprobthreshold / 100)    # Note conversion from percentage
-    fmaskConfig.setEqn20NirSnowThresh(cmdargs.nirsnowthreshold)
-    fmaskConfig.setEqn20GreenSnowThresh(cmdargs.greensnowthreshold)
-    fmaskConfig.setSen2displacementTest(cmdargs.parallaxtest)
-    
-    # Work out a suitable buffer size, in pixels, dependent on the resolution of the input TOA image
-    toaImgInfo = fileinfo.ImageInfo(cmdargs.toa)
-    fmaskConfig.setCloudBufferSize(int(cmdargs.cloudbufferdistance / toaImgInfo.xRes))
-    fmaskConfig.setShadowBufferSize(int(cmdargs.shadowbufferdistance / toaImgInfo.xRes))
-    
-    fmask.doFmask(fmaskFilenames, fmaskConfig)
-    
-    if (anglesfile != cmdargs.anglesfile):
-        # Must have been a temporary, so remove it
-        fmask.deleteRaster(anglesfile)
-    
-    if tempStack and not cmdargs.keepintermediates:
-        for fn in [cmdargs.toa, cmdargs.anglesfile]:
-            if os.path.exists(fn):
-                fmask.deleteRaster(fn)
-    
+
+    # All our intermediate files go into a single temporary directory for this run, 
+    # so they are all removed together at the end, even if something fails. 
+    # This includes fmask's own intermediate files. 
+    if cmdargs.keepintermediates:
+        keptTempDir = tempfile.mkdtemp(dir=cmdargs.tempdir, prefix="fmask_tmp_")
+        runTempDir = contextlib.nullcontext(keptTempDir)
+    else:
+        runTempDir = tempfile.TemporaryDirectory(dir=cmdargs.tempdir, prefix="fmask_tmp_")
+
+    with gdalDefaultSettings(), runTempDir as tempdir:
+        if cmdargs.safedir is not None or cmdargs.granuledir is not None:
+            makeStackAndAngles(cmdargs, tempdir)
+        topMeta = readTopLevelMeta(cmdargs)
+        
+        (anglesfile, toaImgInfo) = checkAnglesFile(cmdargs.anglesfile, cmdargs.toa, tempdir)
+        anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
+        
+        fmaskFilenames = config.FmaskFilenames()
+        fmaskFilenames.setTOAReflectanceFile(cmdargs.toa)
+        fmaskFilenames.setOutputCloudMaskFile(cmdargs.output)
+        
+        fmaskConfig = config.FmaskConfig(config.FMASK_SENTINEL2)
+        fmaskConfig.setAnglesInfo(anglesInfo)
+        fmaskConfig.setKeepIntermediates(cmdargs.keepintermediates)
+        fmaskConfig.setVerbose(cmdargs.verbose)
+        fmaskConfig.setTempDir(tempdir)
+        fmaskConfig.setTOARefScaling(topMeta.scaleVal)
+        offsetDict = makeRefOffsetDict(topMeta)
+        fmaskConfig.setTOARefOffsetDict(offsetDict)
+        fmaskConfig.setMinCloudSize(cmdargs.mincloudsize)
+        fmaskConfig.setEqn17CloudProbThresh(cmdargs.cloudprobthreshold / 100)    # Note conversion from percentage
+        fmaskConfig.setEqn20NirSnowThresh(cmdargs.nirsnowthreshold)
+        fmaskConfig.setEqn20GreenSnowThresh(cmdargs.greensnowthreshold)
+        fmaskConfig.setSen2displacementTest(cmdargs.parallaxtest)
+        
+        # Work out a suitable buffer size, in pixels, dependent on the resolution of the input TOA image
+        fmaskConfig.setCloudBufferSize(int(cmdargs.cloudbufferdistance / toaImgInfo.xRes))
+        fmaskConfig.setShadowBufferSize(int(cmdargs.shadowbufferdistance / toaImgInfo.xRes))
+        
+        fmask.doFmask(fmaskFilenames, fmaskConfig)
+
+    # With --keepintermediates, say where they were kept. If none were made, 
+    # don't leave an empty directory behind. 
+    if cmdargs.keepintermediates:
+        if len(os.listdir(keptTempDir)) == 0:
+            os.rmdir(keptTempDir)
+        elif cmdargs.verbose:
+            print("Intermediate files kept in {}".format(keptTempDir))